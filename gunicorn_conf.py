@@ -0,0 +1,41 @@
+import multiprocessing
+import os
+import subprocess
+import sys
+
+# ==========================
+# GUNICORN
+# ==========================
+
+# gevent-воркер сам робить monkey.patch_all() до імпорту main:app. Драйвери БД
+# це не покриває: psycopg2 перемикаємо на gevent через psycogreen (post_fork),
+# а sqlite3 лишається блокуючим викликом — під SQLite запити тримають воркер
+bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+worker_class = "gevent"
+workers = int(os.getenv("WEB_CONCURRENCY", multiprocessing.cpu_count() * 2 + 1))
+worker_connections = int(os.getenv("WORKER_CONNECTIONS", "1000"))
+
+
+def on_starting(server):
+    # схема БД — один раз у майстрі, до fork воркерів, інакше вони змагаються
+    # за CREATE TABLE/INDEX. В окремому процесі: якби майстер сам імпортував main,
+    # воркери успадкували б модуль, завантажений ще до monkey-patch
+    subprocess.run([sys.executable, "-c", "import main; main.init_db()"], check=True)
+
+
+def post_fork(server, worker):
+    # psycopg2 — C-драйвер, monkey.patch_all() його не бачить; без psycogreen
+    # кожен запит до PostgreSQL блокував би хаб разом з усіма greenlet-ами воркера
+    if os.getenv("DATABASE_URL", "").startswith(("postgres://", "postgresql://", "postgresql+psycopg2://")):
+        from psycogreen.gevent import patch_psycopg
+
+        patch_psycopg()
+
+
+def post_worker_init(worker):
+    # перший хеш у воркері платить за холодні кеші та старт потоку пулу —
+    # робимо його тут, а не на першому /api/login
+    # (post_fork не підходить: там ще немає monkey-patch і завантаженого застосунку)
+    import main
+
+    main.hash_password("warmup")
@@ -1,13 +1,31 @@
+import hashlib
 import os
-import random
+import secrets
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+from typing import Optional
 
-from flask import Flask, jsonify, request, session, render_template
+from flask import Flask, Response, jsonify, request, session, render_template, stream_with_context
 from flask_cors import CORS
-from sqlalchemy import create_engine, Column, Integer, String, Float, ForeignKey, DateTime
-from sqlalchemy.orm import sessionmaker, declarative_base, relationship, scoped_session
+import orjson
+import bcrypt
+from sqlalchemy import case, create_engine, event, insert, inspect, select, text, update, Column, Integer, String, ForeignKey, DateTime, Index
+from sqlalchemy.orm import (
+    sessionmaker, declarative_base, relationship, scoped_session,
+    selectinload, joinedload, raiseload,
+)
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.hybrid import hybrid_property
 from passlib.context import CryptContext
 
+try:
+    from gevent import monkey
+    from gevent.threadpool import ThreadPoolExecutor as GeventThreadPoolExecutor
+except ImportError:
+    monkey = None
+
 # ==========================
 # НАЛАШТУВАННЯ
 # ==========================
@@ -17,13 +35,45 @@ app.secret_key = os.getenv("SECRET_KEY", "CHANGE_ME_SUPER_SECRET")
 CORS(app, supports_credentials=True)
 
 CURRENCY = "V$"
-START_BALANCE = 20.0
+# гроші зберігаємо й рахуємо в цілих копійках; Decimal — лише на вході й у JSON
+# (SQLite віддає NUMERIC-колонкам REAL, тож дробові суми там знову стали б float)
+CENT = Decimal("0.01")
+START_BALANCE_CENTS = 2000
+
+COMMISSION_SILVER = Decimal("0.02")
+COMMISSION_GOLD = Decimal("0.015")
+COMMISSION_PLATINUM = Decimal("0.01")
+
+# (мінімум балів, рівень, комісія) — від найвищого рівня до найнижчого
+LEVELS = (
+    (1000, "Platinum", COMMISSION_PLATINUM),
+    (200, "Gold", COMMISSION_GOLD),
+    (0, "Silver", COMMISSION_SILVER),
+)
+
+PARTNERS_CACHE_TTL = int(os.getenv("PARTNERS_CACHE_TTL", "60"))  # секунди
+
+ARGON2_TIME_COST = int(os.getenv("ARGON2_TIME_COST", "2"))
+ARGON2_MEMORY_COST = int(os.getenv("ARGON2_MEMORY_COST", "65536"))  # KiB
+ARGON2_PARALLELISM = int(os.getenv("ARGON2_PARALLELISM", "2"))
+
+# старі bcrypt-хеші перевіряємо напряму через bcrypt (бекенд passlib 1.7.4 не працює
+# з bcrypt >= 4.1) і при вході перехешовуємо в argon2id
+LEGACY_BCRYPT_PREFIXES = ("$2a$", "$2b$", "$2y$")
 
-COMMISSION_SILVER = 0.02
-COMMISSION_GOLD = 0.015
-COMMISSION_PLATINUM = 0.01
+CARD_NUMBER_ATTEMPTS = 5
 
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///vyshcard.db")
+# пул — на кожен gunicorn-воркер окремо: разом до
+# workers * (DB_POOL_SIZE + DB_MAX_OVERFLOW) з'єднань (на 4 ядрах 9 * 10 = 90).
+# Сума по всіх інстансах має лишатися нижчою за max_connections у PostgreSQL
+# (типово 100) із запасом на адмінські підключення — інакше зменшуйте ці значення
+# або WEB_CONCURRENCY.
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "5"))
+
+# у дев-режимі будь-який непередбачений lazy load кидає виняток (ловимо N+1)
+RAISE_ON_LAZY_LOAD = os.getenv("FLASK_DEBUG") == "1"
 
 # ==========================
 # БАЗА ДАНИХ
@@ -31,8 +81,22 @@ DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///vyshcard.db")
 
 if DATABASE_URL.startswith("sqlite"):
     engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
+
+    # WAL: читачі не чекають на писача; NORMAL прибирає fsync на кожен commit
+    @event.listens_for(engine, "connect")
+    def _sqlite_pragmas(dbapi_conn, _record):
+        cur = dbapi_conn.cursor()
+        cur.execute("PRAGMA journal_mode=WAL")
+        cur.execute("PRAGMA synchronous=NORMAL")
+        cur.execute("PRAGMA busy_timeout=5000")
+        cur.close()
 else:
-    engine = create_engine(DATABASE_URL)
+    engine = create_engine(
+        DATABASE_URL,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_pre_ping=True,
+    )
 
 Base = declarative_base()
 SessionLocal = scoped_session(sessionmaker(bind=engine, autoflush=False, autocommit=False))
@@ -44,21 +108,36 @@ class User(Base):
     id = Column(Integer, primary_key=True, index=True)
     username = Column(String, unique=True, index=True)
     password_hash = Column(String)
-    balance = Column(Float, default=START_BALANCE)
+    balance_cents = Column(Integer, default=START_BALANCE_CENTS)
     points = Column(Integer, default=0)
-    level = Column(String, default="Silver")
     avatar_url = Column(String, nullable=True)
     bio = Column(String, nullable=True)
 
     cards = relationship("Card", back_populates="owner")
     txns = relationship("Transaction", back_populates="user")
 
+    @property
+    def balance(self) -> Decimal:
+        return cents_to_money(self.balance_cents)
+
+    # рівень не зберігаємо — він завжди випливає з балів
+    @hybrid_property
+    def level(self) -> str:
+        return level_for_points(self.points or 0)
+
+    @level.expression
+    def level(cls):
+        return case(
+            *[(cls.points >= min_points, name) for min_points, name, _ in LEVELS[:-1]],
+            else_=LEVELS[-1][1],
+        )
+
 
 class Card(Base):
     __tablename__ = "cards"
 
     id = Column(Integer, primary_key=True, index=True)
-    user_id = Column(Integer, ForeignKey("users.id"))
+    user_id = Column(Integer, ForeignKey("users.id"), index=True)
     number = Column(String, unique=True, index=True)
     created_at = Column(DateTime, default=datetime.utcnow)
 
@@ -67,17 +146,27 @@ class Card(Base):
 
 class Transaction(Base):
     __tablename__ = "transactions"
+    # покриває і фільтр за user_id (лівий префікс), і сортування історії
+    __table_args__ = (Index("ix_txn_user_ts", "user_id", "timestamp"),)
 
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id"))
-    amount = Column(Float)
-    commission = Column(Float)
+    amount_cents = Column(Integer)
+    commission_cents = Column(Integer)
     direction = Column(String)  # incoming / outgoing
     other_user = Column(String)
     timestamp = Column(DateTime, default=datetime.utcnow)
 
     user = relationship("User", back_populates="txns")
 
+    @property
+    def amount(self) -> Decimal:
+        return cents_to_money(self.amount_cents)
+
+    @property
+    def commission(self) -> Decimal:
+        return cents_to_money(self.commission_cents)
+
 
 class Partner(Base):
     __tablename__ = "partners"
@@ -91,17 +180,61 @@ class Partner(Base):
     logo_url = Column(String, nullable=True)
 
 
-Base.metadata.create_all(bind=engine)
+# (таблиця, стара колонка) — суми, що раніше зберігалися дробовими числами
+MONEY_COLUMNS = (
+    ("users", "balance"),
+    ("transactions", "amount"),
+    ("transactions", "commission"),
+)
+
+
+def _migrate_money_to_cents(conn):
+    # старі бази: додаємо *_cents і переносимо суми з дробових колонок у копійки
+    insp = inspect(conn)
+    for table, column in MONEY_COLUMNS:
+        existing = {c["name"] for c in insp.get_columns(table)}
+        cents = f"{column}_cents"
+        if cents in existing:
+            continue
+        conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {cents} INTEGER"))
+        if column in existing:
+            conn.execute(text(f"UPDATE {table} SET {cents} = ROUND({column} * 100)"))
+
+
+def init_db():
+    # викликається один раз до старту воркерів (gunicorn on_starting або __main__),
+    # бо паралельні create_all/CREATE INDEX з кількох процесів конфліктують
+    Base.metadata.create_all(bind=engine)
+
+    with engine.begin() as conn:
+        _migrate_money_to_cents(conn)
+
+    # create_all не чіпає вже існуючі таблиці — індекси, додані пізніше, створюємо окремо
+    for table in Base.metadata.sorted_tables:
+        for idx in table.indexes:
+            idx.create(bind=engine, checkfirst=True)
+
+
+pwd_ctx = CryptContext(
+    schemes=["argon2"],
+    deprecated="auto",
+    argon2__type="ID",
+    argon2__time_cost=ARGON2_TIME_COST,
+    argon2__memory_cost=ARGON2_MEMORY_COST,
+    argon2__parallelism=ARGON2_PARALLELISM,
+)
+
+# хешування важке для CPU, але відпускає GIL — виносимо його в справжні потоки,
+# щоб воркер тим часом обслуговував інші запити (під gevent — через пул хаба)
+if monkey is not None and monkey.is_module_patched("threading"):
+    _HASH_POOL = GeventThreadPoolExecutor(max_workers=os.cpu_count() or 1)
+else:
+    _HASH_POOL = ThreadPoolExecutor(max_workers=os.cpu_count() or 1)
 
-pwd_ctx = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
-
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
+@app.teardown_appcontext
+def remove_session(exc=None):
+    SessionLocal.remove()
 
 
 # ==========================
@@ -109,29 +242,114 @@ def get_db():
 # ==========================
 
 def generate_card_number() -> str:
-    return f"VY-{random.randint(1000, 9999)}-{random.randint(1000, 9999)}"
+    return f"VY-{secrets.randbelow(10000):04d}-{secrets.randbelow(10000):04d}"
 
 
-def commission_for_level(level: str) -> float:
-    if level == "Gold":
-        return COMMISSION_GOLD
-    if level == "Platinum":
-        return COMMISSION_PLATINUM
-    return COMMISSION_SILVER
+def strict_query(db_session, *entities):
+    q = db_session.query(*entities)
+    if RAISE_ON_LAZY_LOAD:
+        q = q.options(raiseload("*"))
+    return q
 
 
-def recalc_level(user: User):
-    pts = user.points
-    if pts >= 1000:
-        user.level = "Platinum"
-    elif pts >= 200:
-        user.level = "Gold"
-    else:
-        user.level = "Silver"
+def strict_get(db_session, entity, ident, *options):
+    if RAISE_ON_LAZY_LOAD:
+        options += (raiseload("*"),)
+    return db_session.get(entity, ident, options=options)
+
+
+PARTNER_FIELDS = ("id", "name", "discount", "category", "note", "url", "logo_url")
+TXN_FIELDS = ("amount", "commission", "direction", "other_user", "timestamp")
+
+
+def serialize(obj, fields) -> dict:
+    return {f: getattr(obj, f) for f in fields}
+
+
+def _json_default(obj):
+    # у JSON суми лишаються числами, як і раніше
+    if isinstance(obj, Decimal):
+        return float(obj)
+    raise TypeError
+
+
+def to_json(data) -> bytes:
+    # orjson швидший за stdlib json і сам серіалізує datetime в ISO 8601
+    return orjson.dumps(data, default=_json_default)
+
+
+def json_body() -> dict:
+    # тіло, що не є JSON-обʼєктом (масив, рядок, число), вважаємо порожнім
+    data = request.get_json(silent=True)
+    return data if isinstance(data, dict) else {}
+
+
+def json_response(data) -> Response:
+    return Response(to_json(data), mimetype="application/json")
+
+
+def hash_password(password: str) -> str:
+    return _HASH_POOL.submit(pwd_ctx.hash, password).result()
+
+
+def _check_password(password: str, password_hash: str) -> bool:
+    if password_hash.startswith(LEGACY_BCRYPT_PREFIXES):
+        # bcrypt враховує лише перші 72 байти — passlib так само обрізав пароль
+        return bcrypt.checkpw(password.encode("utf-8")[:72], password_hash.encode("ascii"))
+    return pwd_ctx.verify(password, password_hash)
+
+
+def verify_password(password: str, password_hash: Optional[str]) -> bool:
+    # немає користувача — все одно рахуємо хеш, щоб за часом відповіді
+    # не можна було визначити, чи існує такий логін
+    if password_hash is None:
+        _HASH_POOL.submit(pwd_ctx.dummy_verify).result()
+        return False
+    try:
+        return _HASH_POOL.submit(_check_password, password, password_hash).result()
+    except Exception:
+        # битий хеш чи збій бекенда — це невдалий вхід, а не 500
+        app.logger.exception("Не вдалося перевірити пароль")
+        return False
+
+
+def password_needs_rehash(password_hash: str) -> bool:
+    return password_hash.startswith(LEGACY_BCRYPT_PREFIXES) or pwd_ctx.needs_update(password_hash)
+
+
+def cents_to_money(cents: int) -> Decimal:
+    return Decimal(cents).scaleb(-2)
+
+
+def parse_money(value) -> int:
+    # сума з запиту -> копійки; частки копійки не округлюємо мовчки, а відхиляємо
+    try:
+        amount = Decimal(str(value))
+        if not amount.is_finite() or amount != amount.quantize(CENT):
+            raise ValueError
+    except InvalidOperation:
+        raise ValueError
+    return int(amount * 100)
+
+
+def _level_for(points: int):
+    for entry in LEVELS:
+        if points >= entry[0]:
+            return entry
+    return LEVELS[-1]
+
+
+def level_for_points(points: int) -> str:
+    return _level_for(points)[1]
+
+
+def commission_for_points(points: int, amount_cents: int) -> int:
+    rate = _level_for(points)[2]
+    return int((amount_cents * rate).quantize(Decimal(1), rounding=ROUND_HALF_UP))
 
 
 def seed_partners(db_session):
-    if db_session.query(Partner).count() > 0:
+    if db_session.query(Partner.id).first() is not None:
         return
     demo = [
         Partner(
@@ -155,23 +373,25 @@ def seed_partners(db_session):
     ]
     db_session.add_all(demo)
     db_session.commit()
+    invalidate_partners_cache()
 
 
 @app.before_first_request
 def init_data():
     db = SessionLocal()
     seed_partners(db)
-    db.close()
 
 
-def get_current_user():
-    user_id = session.get("user_id")
+def current_user_id():
+    return session.get("user_id")
+
+
+def load_current_user(db_session, *options):
+    # один SELECT з потрібними обробнику eager-опціями
+    user_id = current_user_id()
     if not user_id:
         return None
-    db = SessionLocal()
-    user = db.query(User).filter(User.id == user_id).first()
-    db.close()
-    return user
+    return strict_get(db_session, User, user_id, *options)
 
 
 # ==========================
@@ -189,51 +409,62 @@ def index():
 
 @app.post("/api/register")
 def api_register():
-    username = request.form.get("username") or request.json.get("username")
-    password = request.form.get("password") or request.json.get("password")
+    data = json_body() or request.form
+    username = data.get("username")
+    password = data.get("password")
     if not username or not password:
         return jsonify({"detail": "Вкажи логін і пароль"}), 400
 
     db = SessionLocal()
     if db.query(User).filter(User.username == username).first():
-        db.close()
         return jsonify({"detail": "Такий логін вже існує"}), 400
 
-    user = User(
-        username=username,
-        password_hash=pwd_ctx.hash(password),
-        balance=START_BALANCE,
-        points=0,
-        level="Silver",
-    )
-    db.add(user)
-    db.commit()
-    db.refresh(user)
-
-    card = Card(user_id=user.id, number=generate_card_number())
-    db.add(card)
-    db.commit()
+    password_hash = hash_password(password)
+    # користувач і картка комітяться разом — без картки логін не лишається зайнятим.
+    # Номер унікальний на рівні БД: при колізії відкочуємо обидва й пробуємо інший
+    for _ in range(CARD_NUMBER_ATTEMPTS):
+        user = User(
+            username=username,
+            password_hash=password_hash,
+            balance_cents=START_BALANCE_CENTS,
+            points=0,
+        )
+        card = Card(owner=user, number=generate_card_number())
+        db.add(user)
+        try:
+            db.commit()
+            break
+        except IntegrityError:
+            db.rollback()
+            # логін міг зайняти паралельний запит — тоді повтор не допоможе
+            if db.query(User.id).filter(User.username == username).first() is not None:
+                return jsonify({"detail": "Такий логін вже існує"}), 400
+    else:
+        return jsonify({"detail": "Не вдалося видати картку, спробуй ще раз"}), 500
 
     session["user_id"] = user.id
-    db.close()
     return jsonify({"status": "ok", "card": card.number})
 
 
 @app.post("/api/login")
 def api_login():
-    username = request.form.get("username") or request.json.get("username")
-    password = request.form.get("password") or request.json.get("password")
+    data = json_body() or request.form
+    username = data.get("username")
+    password = data.get("password")
     if not username or not password:
         return jsonify({"detail": "Вкажи логін і пароль"}), 400
 
     db = SessionLocal()
     user = db.query(User).filter(User.username == username).first()
-    if not user or not pwd_ctx.verify(password, user.password_hash):
-        db.close()
+    if not verify_password(password, user.password_hash if user else None):
         return jsonify({"detail": "Невірний логін або пароль"}), 400
 
+    # застарілий хеш (bcrypt або інші параметри) — тихо перехешовуємо
+    if password_needs_rehash(user.password_hash):
+        user.password_hash = hash_password(password)
+        db.commit()
+
     session["user_id"] = user.id
-    db.close()
     return jsonify({"status": "ok"})
 
 
@@ -249,12 +480,11 @@ def api_logout():
 
 @app.get("/api/me")
 def api_me():
-    user = get_current_user()
+    db = SessionLocal()
+    user = load_current_user(db, selectinload(User.cards))
     if not user:
         return jsonify({"detail": "Не авторизовано"}), 401
 
-    db = SessionLocal()
-    user = db.query(User).filter(User.id == user.id).first()
     data = {
         "username": user.username,
         "balance": user.balance,
@@ -265,28 +495,25 @@ def api_me():
         "cards": [c.number for c in user.cards],
         "currency": CURRENCY,
     }
-    db.close()
-    return jsonify(data)
+    return json_response(data)
 
 
 @app.post("/api/profile")
 def api_profile():
-    user = get_current_user()
+    db = SessionLocal()
+    user = load_current_user(db)
     if not user:
         return jsonify({"detail": "Не авторизовано"}), 401
 
-    data = request.json or {}
+    data = json_body()
     avatar_url = data.get("avatar_url")
     bio = data.get("bio")
 
-    db = SessionLocal()
-    u = db.query(User).filter(User.id == user.id).first()
     if avatar_url is not None:
-        u.avatar_url = avatar_url
+        user.avatar_url = avatar_url
     if bio is not None:
-        u.bio = bio
+        user.bio = bio
     db.commit()
-    db.close()
     return jsonify({"status": "ok"})
 
 
@@ -294,23 +521,29 @@ def api_profile():
 # API: ПАРТНЕРИ
 # ==========================
 
+# (час формування, etag, готовий JSON) — партнери майже не змінюються
+_partners_cache = (0.0, None, None)
+
+
+def invalidate_partners_cache():
+    global _partners_cache
+    _partners_cache = (0.0, None, None)
+
+
 @app.get("/api/partners")
 def api_partners():
-    db = SessionLocal()
-    partners = db.query(Partner).all()
-    out = []
-    for p in partners:
-        out.append({
-            "id": p.id,
-            "name": p.name,
-            "discount": p.discount,
-            "category": p.category,
-            "note": p.note,
-            "url": p.url,
-            "logo_url": p.logo_url,
-        })
-    db.close()
-    return jsonify(out)
+    global _partners_cache
+    ts, etag, payload = _partners_cache
+    if payload is None or time.monotonic() - ts >= PARTNERS_CACHE_TTL:
+        db = SessionLocal()
+        partners = db.query(Partner).all()
+        payload = to_json([serialize(p, PARTNER_FIELDS) for p in partners])
+        etag = hashlib.md5(payload).hexdigest()
+        _partners_cache = (time.monotonic(), etag, payload)
+
+    resp = Response(payload, mimetype="application/json")
+    resp.set_etag(etag)
+    return resp.make_conditional(request)
 
 
 # ==========================
@@ -319,76 +552,96 @@ def api_partners():
 
 @app.post("/api/transfer")
 def api_transfer():
-    user = get_current_user()
-    if not user:
+    db = SessionLocal()
+    sender = load_current_user(db)
+    if not sender:
         return jsonify({"detail": "Не авторизовано"}), 401
 
-    data = request.json or {}
+    data = json_body()
     to_username = data.get("to_username")
-    amount = data.get("amount")
 
     try:
-        amount = float(amount)
-    except (TypeError, ValueError):
+        amount_cents = parse_money(data.get("amount"))
+    except ValueError:
         return jsonify({"detail": "Некоректна сума"}), 400
 
-    if amount <= 0:
+    if amount_cents <= 0:
         return jsonify({"detail": "Сума має бути більшою за 0"}), 400
 
-    db = SessionLocal()
-    sender = db.query(User).filter(User.id == user.id).first()
     receiver = db.query(User).filter(User.username == to_username).first()
 
     if not receiver:
-        db.close()
         return jsonify({"detail": "Отримувача не знайдено"}), 404
 
-    rate = commission_for_level(sender.level)
-    commission = round(amount * rate, 2)
-    total = amount + commission
-
-    if sender.balance < total:
-        db.close()
-        return jsonify({"detail": f"Недостатньо коштів (потрібно {total} {CURRENCY})"}), 400
-
-    sender.balance -= total
-    receiver.balance += amount
-
-    earned_points = int(amount // 50)
-    sender.points += earned_points
-    recalc_level(sender)
-
-    out_tx = Transaction(
-        user_id=sender.id,
-        amount=amount,
-        commission=commission,
-        direction="outgoing",
-        other_user=receiver.username,
+    commission_cents = commission_for_points(sender.points, amount_cents)
+    total_cents = amount_cents + commission_cents
+
+    earned_points = amount_cents // 5000  # 1 бал за кожні 50 V$
+
+    # блокуємо обидва рядки завжди в порядку id: зустрічні перекази A→B і B→A
+    # інакше взяли б блокування навхрест і впали б у deadlock (SQLite FOR UPDATE ігнорує)
+    db.execute(
+        select(User.id)
+        .where(User.id.in_((sender.id, receiver.id)))
+        .order_by(User.id)
+        .with_for_update()
+    ).all()
+
+    # списання з перевіркою балансу одним UPDATE — рядок тримаємо до commit,
+    # тож паралельні перекази не можуть витратити ті самі кошти двічі
+    debited = db.execute(
+        update(User)
+        .where(User.id == sender.id, User.balance_cents >= total_cents)
+        .values(balance_cents=User.balance_cents - total_cents, points=User.points + earned_points)
+        .execution_options(synchronize_session=False)
     )
-    in_tx = Transaction(
-        user_id=receiver.id,
-        amount=amount,
-        commission=0.0,
-        direction="incoming",
-        other_user=sender.username,
+    if debited.rowcount != 1:
+        db.rollback()
+        return jsonify({"detail": f"Недостатньо коштів (потрібно {cents_to_money(total_cents)} {CURRENCY})"}), 400
+
+    db.execute(
+        update(User)
+        .where(User.id == receiver.id)
+        .values(balance_cents=User.balance_cents + amount_cents)
+        .execution_options(synchronize_session=False)
     )
 
-    db.add(out_tx)
-    db.add(in_tx)
+    # баланс і бали змінені в SQL — перечитуємо, поки рядок ще заблокований
+    db.refresh(sender)
+    new_balance, new_level = sender.balance, sender.level
+
+    db.execute(
+        insert(Transaction),
+        [
+            {
+                "user_id": sender.id,
+                "amount_cents": amount_cents,
+                "commission_cents": commission_cents,
+                "direction": "outgoing",
+                "other_user": receiver.username,
+            },
+            {
+                "user_id": receiver.id,
+                "amount_cents": amount_cents,
+                "commission_cents": 0,
+                "direction": "incoming",
+                "other_user": sender.username,
+            },
+        ],
+    )
     db.commit()
 
     result = {
         "status": "ok",
-        "sent": amount,
-        "commission": commission,
-        "total_spent": total,
+        "sent": cents_to_money(amount_cents),
+        "commission": cents_to_money(commission_cents),
+        "total_spent": cents_to_money(total_cents),
         "currency": CURRENCY,
-        "new_balance": sender.balance,
+        "new_balance": new_balance,
         "earned_points": earned_points,
-        "new_level": sender.level,
+        "new_level": new_level,
     }
-    db.close()
-    return jsonify(result)
+    return json_response(result)
 
 
 # ==========================
@@ -397,24 +650,28 @@ def api_transfer():
 
 @app.get("/api/history")
 def api_history():
-    user = get_current_user()
-    if not user:
+    user_id = current_user_id()
+    if not user_id:
         return jsonify({"detail": "Не авторизовано"}), 401
 
     db = SessionLocal()
-    u = db.query(User).filter(User.id == user.id).first()
-    txns = sorted(u.txns, key=lambda t: t.timestamp, reverse=True)
-    res = []
-    for t in txns:
-        res.append({
-            "amount": t.amount,
-            "commission": t.commission,
-            "direction": t.direction,
-            "other_user": t.other_user,
-            "timestamp": t.timestamp.isoformat(),
-        })
-    db.close()
-    return jsonify(res)
+    txns = (
+        strict_query(db, Transaction)
+        .filter(Transaction.user_id == user_id)
+        .order_by(Transaction.timestamp.desc())
+        .yield_per(500)
+    )
+
+    # віддаємо JSON-масив частинами — пам'ять не росте з довжиною історії
+    def generate():
+        yield b"["
+        for i, t in enumerate(txns):
+            if i:
+                yield b","
+            yield to_json(serialize(t, TXN_FIELDS))
+        yield b"]"
+
+    return Response(stream_with_context(generate()), mimetype="application/json")
 
 
 # ==========================
@@ -424,9 +681,13 @@ def api_history():
 @app.get("/api/card/<number>")
 def api_card(number):
     db = SessionLocal()
-    card = db.query(Card).filter(Card.number == number).first()
+    card = (
+        strict_query(db, Card)
+        .options(joinedload(Card.owner))
+        .filter(Card.number == number)
+        .first()
+    )
     if not card:
-        db.close()
         return jsonify({"detail": "Картку не знайдено"}), 404
     owner = card.owner
     data = {
@@ -436,9 +697,9 @@ def api_card(number):
         "bio": owner.bio,
         "card": card.number,
     }
-    db.close()
     return jsonify(data)
 
 
 if __name__ == "__main__":
+    init_db()
     app.run(debug=True)